@@ -1,6 +1,10 @@
 #! /usr/bin/env python3
 
+import operator
+import re
 import sys
+from array import array
+from functools import lru_cache
 
 """SPI - Simple Pascal Interpreter"""
 
@@ -14,105 +18,80 @@ import sys
 #
 # EOF (end-of-file) token is used to indicate that 
 # there is no more input for lexical analysis
-INTEGER, PLUS, MINUS, MUL, DIV, LPAREN, RPAREN, EOF = (
-    'INTEGER', 'PLUS', 'MINUS', 'MUL', 'DIV', '(', ')', 'EOF'
-)
-
-class Token(object):
-    def __init__(self, type, value):
-        self.type = type
-        self.value = value
-    
-    def __str__(self):
-        """String representation of the class instance.
-
-        Examples:
-            Token(INTEGER, 3)
-            Token(PLUS, '+')
-            Token(MUL, '*')
-        """
-        return 'Token({type}, {value})'.format(
-            type = self.type,
-            value = repr(self.value)
-        )
-    
-    def __repr__(self):
-        return self.__str__()
-
+#
+# Types are small ints so comparing them is cheap; INTEGER
+# and the four operators double as the interpreter's opcodes
+#
+# Tokens themselves are plain (type, value) tuples, e.g.
+# (INTEGER, 3), (PLUS, '+') or (EOF, None)
+INTEGER, PLUS, MINUS, MUL, DIV, LPAREN, RPAREN, EOF = range(8)
+
+# What each binary operator token computes
+BINARY_OPS = {
+    PLUS: operator.add,
+    MINUS: operator.sub,
+    MUL: operator.mul,
+    DIV: operator.floordiv,
+}
 
 class Lexer(object):
+    # Each match is one token: an integer, an operator or
+    # parenthesis, or a single character the language doesn't
+    # know about. Whitespace in front of a token is swallowed by
+    # the same match rather than needing a match of its own.
+    # Digits are the plain range 0-9 rather than \d, so there's no
+    # Unicode category lookup per digit (and Pascal digits are 0-9
+    # anyway); whitespace is still any Unicode whitespace
+    _TOKEN_RE = re.compile(
+        r'\s*(?:(?P<integer>[0-9]+)|(?P<op>[-+*/()])|(?P<error>\S))'
+    )
+    _OPERATORS = {
+        '+': PLUS, '-': MINUS, '*': MUL, '/': DIV, '(': LPAREN, ')': RPAREN
+    }
+
     def __init__(self, text):
         # client string input, e.g. "4 + 2 * 3 - 6 / 2"
         self.text = text
-        # self.pos is an index into self.text
-        self.pos = 0
-        self.current_char = self.text[self.pos]
+        # the scanning itself is done by the regex engine, we just
+        # pull matches off this iterator one at a time
+        self._matches = self._TOKEN_RE.finditer(text)
     
     def error(self):
         raise Exception('Invalid character')
     
-    def advance(self):
-        """Advance 'pos' and set 'current_char'"""
-        self.pos += 1
-        if self.pos > len(self.text) - 1:
-            self.current_char = None # indicates end of input
-        else:
-            self.current_char = self.text[self.pos]
-    
-    def skip_whitespace(self):
-        while self.current_char is not None and self.current_char.isspace():
-            self.advance()
-    
-    def integer(self):
-        """Return a (multidigit) integer consumed from the input"""
-        result = ''
-        while self.current_char is not None and self.current_char.isdigit():
-            result += self.current_char
-            self.advance()
-        return int(result)
-    
     def get_next_token(self):
         """Lexical analyser, aka scanner / tokeniser
 
         This method is responsible for splitting the input apart
         into tokens, one token at a time.
         """
-        while self.current_char is not None:
-
-            if self.current_char.isspace():
-                self.skip_whitespace()
-                continue
-            
-            if self.current_char.isdigit():
-                return Token(INTEGER, self.integer())
-            
-            if self.current_char == '+':
-                self.advance()
-                return Token(PLUS, '+')
-            
-            if self.current_char == '-':
-                self.advance()
-                return Token(MINUS, '-')
-            
-            if self.current_char == '*':
-                self.advance()
-                return Token(MUL, '*')
-            
-            if self.current_char == '/':
-                self.advance()
-                return Token(DIV, '/')
-            
-            if self.current_char == '(':
-                self.advance()
-                return Token(LPAREN, '(')
-            
-            if self.current_char == ')':
-                self.advance()
-                return Token(RPAREN, ')')
-
-            self.error()
+        for match in self._matches:
+            # name of the group that matched
+            kind = match.lastgroup
+
+            if kind == 'integer':
+                # the whole digit run converted in one go
+                return (INTEGER, int(match.group('integer')))
+
+            if kind == 'op':
+                op = match.group('op')
+                return (self._OPERATORS[op], op)
+
+            if kind == 'error':
+                self.error()
         
-        return Token(EOF, None)
+        return (EOF, None)
+
+    def tokenize(self):
+        """Return the whole input as a list of tokens ending in EOF"""
+        tokens = []
+        get_next_token = self.get_next_token
+        token = get_next_token()
+        while token[0] != EOF:
+            tokens.append(token)
+            token = get_next_token()
+        tokens.append(token)
+        return tokens
 
 
 ###############################################################
@@ -122,91 +101,105 @@ class Lexer(object):
 ###############################################################
 
 class AST(object):
-    pass
+    # nodes are small and numerous, so none of them get a __dict__
+    __slots__ = ()
 
 
 class BinOp(AST):
+    __slots__ = ('left', 'op', 'right')
+
     def __init__(self, left, op, right):
         self.left = left
-        self.token = self.op = op
+        self.op = op
         self.right = right
     
 
 class Num(AST):
+    __slots__ = ('token', 'value')
+
     def __init__(self, token):
         self.token = token
-        self.value = token.value
+        self.value = token[1]
 
 
 class Parser(object):
+    # How tightly each binary operator binds; they are all
+    # left-associative. LPAREN isn't an operator, it just waits
+    # on the operator stack with the lowest precedence of all
+    PRECEDENCE = {PLUS: 1, MINUS: 1, MUL: 2, DIV: 2}
+
     def __init__(self, lexer):
         self.lexer = lexer
-        # set current token to first token taken from input
-        self.current_token = self.lexer.get_next_token()
+        # lex the whole input up front
+        self.tokens = self.lexer.tokenize()
     
     def error(self):
         raise Exception('Invalid syntax')
-    
-    def eat(self, token_type):
-        # compares current token type to passed token type
-        # and if they match then 'eats' the current token
-        # and sets current token to self.get_next_token,
-        # otherwise raise an Exception
-        if self.current_token.type == token_type:
-            # that was tasty give me another
-            self.current_token = self.lexer.get_next_token() 
+
+    def reduce(self, operands, operators):
+        """Combine the top operator with the top two operands
+
+        If both operands are constants the operation is done right
+        away and only its result is kept (constant folding).
+        """
+        op = operators.pop()
+        right = operands.pop()
+        left = operands.pop()
+        if isinstance(left, Num) and isinstance(right, Num):
+            result = BINARY_OPS[op[0]](left.value, right.value)
+            operands.append(Num((INTEGER, result)))
         else:
-            # Yuck, throw a tantrum
-            self.error()
-        
-    def factor(self):
-        """factor   : INTEGER | LPAREN expr RPAREN"""
-        token = self.current_token # what am I looking at
-        if token.type == INTEGER: # I'm looking at an integer
-            self.eat(INTEGER)
-            return Num(token) # therefore I should return a Num node
-        elif token.type == LPAREN: # this is a bracketed expression
-            self.eat(LPAREN)
-            node = self.expr() # evaluate the expression in the middle
-            self.eat(RPAREN)
-            return node # and return it
-    
-    def term(self):
-        """term     : factor ((MUL | DIV) factor)*"""
-        node = self.factor() # we've got a factor here
-
-        while self.current_token.type in (MUL, DIV):
-            # oh, there's an operator
-            token = self.current_token # what kind of operator?
-            if token.type == MUL:
-                self.eat(MUL)
-            elif token.type == DIV:
-                self.eat(DIV)
-            
-            # operator is now the node, with old node on the left and
-            # another factor on the right
-            node = BinOp(left=node, op=token, right=self.factor())
-
-        return node
+            operands.append(BinOp(left=left, op=op, right=right))
 
     def expr(self):
         """
         expr    : term ((PLUS | MINUS) term)*
         term    : factor ((MUL | DIV) factor)*
         factor  : INTEGER | LPAREN expr RPAREN
-        """
-        node = self.term()
-
-        while self.current_token.type in (PLUS, MINUS):
-            token = self.current_token
-            if token.type == PLUS:
-                self.eat(PLUS)
-            elif token.type == MINUS:
-                self.eat(MINUS)
-
-            node = BinOp(left=node, op=token, right=self.term())
 
-        return node
+        Parsed in a single loop with Dijkstra's shunting-yard
+        algorithm rather than one method (and stack frame) per rule.
+        Operands and operators wait on their own stacks until an
+        operator of lower or equal precedence, a closing paren or
+        EOF shows they can be combined.
+        """
+        precedence = self.PRECEDENCE
+        operands = []
+        operators = []
+        expect_operand = True # an operand or '(' has to come next
+
+        for token in self.tokens:
+            token_type = token[0]
+            if expect_operand:
+                if token_type == INTEGER:
+                    operands.append(Num(token))
+                    expect_operand = False
+                elif token_type == LPAREN:
+                    operators.append(token)
+                else:
+                    self.error()
+            elif token_type in precedence:
+                # everything on the stack that binds at least as
+                # tightly has both its operands now
+                token_precedence = precedence[token_type]
+                while (operators and
+                        precedence.get(operators[-1][0], 0) >=
+                        token_precedence):
+                    self.reduce(operands, operators)
+                operators.append(token)
+                expect_operand = True
+            elif token_type == RPAREN or token_type == EOF:
+                while operators and operators[-1][0] != LPAREN:
+                    self.reduce(operands, operators)
+                if token_type == EOF:
+                    if operators: # unclosed '('
+                        self.error()
+                    return operands.pop()
+                if not operators: # unopened ')'
+                    self.error()
+                operators.pop()
+            else:
+                self.error()
 
     def parse(self):
         return self.expr()
@@ -219,35 +212,115 @@ class Parser(object):
 #####################################################################
 
 class NodeVisitor(object):
+    # (visitor class, node class) -> visit_ function, filled in on
+    # first use and shared by every instance. Plain functions are
+    # stored rather than bound methods so the cache holds no
+    # reference to any visitor
+    _dispatch = {}
+
     def visit(self, node):
-        method_name = 'visit_' + type(node).__name__
-        visitor = getattr(self, method_name, self.generic_visit)
-        return visitor(node)
+        key = (type(self), type(node))
+        visitor = NodeVisitor._dispatch.get(key)
+        if visitor is None:
+            method_name = 'visit_' + type(node).__name__
+            visitor = getattr(type(self), method_name, None)
+            if visitor is None:
+                return self.generic_visit(node)
+            NodeVisitor._dispatch[key] = visitor
+        return visitor(self, node)
 
     def generic_visit(self, node):
         raise Exception('No visit_{} method'.format(type(node).__name__))
 
 
-class Interpreter(NodeVisitor):
-    def __init__(self, parser):
-        self.parser = parser
+class Compiler(NodeVisitor):
+    """Flattens an AST into bytecode for the stack machine.
+
+    The program is kept as two parallel sequences: 'code' holds
+    one opcode per instruction and 'operands' holds its argument.
+    Opcodes are the token types: INTEGER pushes its operand onto
+    the stack, PLUS/MINUS/MUL/DIV pop two values and push back
+    the result.
+    """
+    def __init__(self):
+        self.code = array('B')
+        self.operands = []
 
     def visit_BinOp(self, node):
-        if node.op.type == PLUS:
-            return self.visit(node.left) + self.visit(node.right)
-        if node.op.type == MINUS:
-            return self.visit(node.left) - self.visit(node.right)
-        if node.op.type == MUL:
-            return self.visit(node.left) * self.visit(node.right)
-        if node.op.type == DIV:
-            return self.visit(node.left) // self.visit(node.right)
+        # operands have already been emitted by compile()
+        self.code.append(node.op[0])
+        self.operands.append(0)
 
     def visit_Num(self, node):
-        return node.value
+        self.code.append(INTEGER)
+        self.operands.append(node.value)
+
+    def compile(self, tree):
+        # Parser.reduce folds constants as it goes, so a parsed
+        # program is always a single Num and this is one visit.
+        # The BinOp handling below is kept for trees that aren't
+        # fully constant (built by hand, or once the language has
+        # variables); it isn't a hot path today.
+        #
+        # Walk the tree with an explicit stack instead of recursing,
+        # so deep nesting can't hit the recursion limit. Collecting
+        # node, right, left and then reversing gives post-order:
+        # both operands are emitted before the operator using them
+        nodes = []
+        todo = [tree]
+        while todo:
+            node = todo.pop()
+            nodes.append(node)
+            if isinstance(node, BinOp):
+                todo.append(node.left)
+                todo.append(node.right)
+
+        for node in reversed(nodes):
+            self.visit(node)
+        return self.code, self.operands
+
+
+class Interpreter(object):
+    def __init__(self, parser=None):
+        # only needed by interpret(); execute() runs bytecode
+        # that was compiled elsewhere
+        self.parser = parser
+
+    def execute(self, code, operands):
+        """Run compiled bytecode and return the value left on the stack"""
+        stack = []
+        # bind everything the loop touches to locals so each
+        # instruction costs no global or attribute lookups
+        push = stack.append
+        pop = stack.pop
+        binary_ops = BINARY_OPS
+        # there are no jumps, so rather than keeping an instruction
+        # pointer and indexing both sequences with it, step through
+        # them in lockstep
+        for op, operand in zip(code, operands):
+            if op == INTEGER:
+                push(operand)
+            else:
+                b = pop()
+                stack[-1] = binary_ops[op](stack[-1], b)
+        return pop()
 
     def interpret(self):
         tree = self.parser.parse()
-        return self.visit(tree)
+        code, operands = Compiler().compile(tree)
+        return self.execute(code, operands)
+
+
+@lru_cache(maxsize=256)
+def compile_source(text):
+    """Lex, parse and compile 'text' into (code, operands)
+
+    Results are cached by source text, so a line typed into the
+    REPL again (e.g. recalled from history) skips straight to
+    execution.
+    """
+    tree = Parser(Lexer(text)).parse()
+    return Compiler().compile(tree)
 
 
 def main():
@@ -259,10 +332,9 @@ def main():
         if not text:
             sys.exit()
 
-        lexer = Lexer(text)
-        parser = Parser(lexer)
-        interpreter = Interpreter(parser)
-        result = interpreter.interpret()
+        code, operands = compile_source(text)
+        interpreter = Interpreter()
+        result = interpreter.execute(code, operands)
         print(result)
 
 